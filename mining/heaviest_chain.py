@@ -1,8 +1,18 @@
 #! /bin/env python3
 
-# pylint: disable=missing-function-docstring, missing-module-docstring, line-too-long, too-many-statements, too-many-locals, too-many-branches
+# pylint: disable=missing-function-docstring, missing-module-docstring, line-too-long, too-many-statements, too-many-locals, too-many-branches, too-many-arguments, too-many-positional-arguments
+# (simulate() takes every parameter explicitly, so parameter sweeps can call it without going through argparse)
 
 import argparse
+import heapq
+import logging
+import sys
+
+NORMAL=0
+STEP=1
+ALTERNATE=2
+
+STRATEGIES = ["normal", "step", "alternate"]
 
 parser = argparse.ArgumentParser("""
     Heaviest chain attack simulator:\n
@@ -11,119 +21,202 @@ parser = argparse.ArgumentParser("""
             * step: start with a low mining power and then gradually increase
             * alternate: switch between full and half of the mining power
         """)
-parser.add_argument("strategy", type=str, choices=["normal", "step", "alternate"], help="Defines how the miner will behave")
+parser.add_argument("strategy", type=str, choices=STRATEGIES, help="Defines how the miner will behave")
 parser.add_argument("--start-difficulty", type=int, help="What is the initial mining difficulty? Will auto calculated if not set")
 parser.add_argument("--attack-fraction", type=int, default=30, help="What share of the mining power does the attacker have?")
+parser.add_argument("--num-attackers", type=int, default=1, help="How many attackers mine their own chain? They split the attack fraction evenly")
 parser.add_argument("--period-length", type=int, default=5, help="After how many blocks is difficulty recalculated?")
 parser.add_argument("--block-time", type=int, default=60, help="The expected time between blocks")
 parser.add_argument("--num-blocks", type=int, default=50, help="Simulate until the first chain reached this number of blocks")
+parser.add_argument("--early-exit", action="store_true", help="Stop once no chain can overtake the heaviest one anymore. Assumes difficulties do not increase, which may not hold if attackers change their mining power")
+parser.add_argument("-v", "--verbose", action="store_true", help="Print every block and difficulty change, not just the final result")
+
+log = logging.getLogger(__name__)
 
 def calculate_block_interval(difficulty, mining_power):
     ''' This calculates when the next block is being generated '''
     return difficulty / mining_power
 
+# The honest miner always has index 0, attackers follow after it
 HONEST=0
-ATTACKER=1
 
-def to_name(index):
-    if index == HONEST:
-        return "HONEST"
-    return "ATTACKER"
+def miner_names(num_attackers):
+    if num_attackers == 1:
+        return ("HONEST", "ATTACKER")
+    return ("HONEST",) + tuple(f"ATTACKER{idx}" for idx in range(1, num_attackers+1))
 
-def main():
-    args = parser.parse_args()
+def print_status(names, chain_weights, chain_lengths):
+    print("Chain lengths are now " + " ".join(f"{name}={length}" for (name, length) in zip(names, chain_lengths)))
+    print("Chain weights are now " + " ".join(f"{name}={weight}" for (name, weight) in zip(names, chain_weights)))
 
-    if args.attack_fraction >= 50:
-        raise RuntimeError("Attacker must have am minority of the mining power")
-    if args.attack_fraction <= 0:
-        raise RuntimeError("Attacker' must have a mining power >0")
+    # On a tie, the chain with the lower index (i.e., the honest one) wins
+    heaviest = max(range(len(names)), key=chain_weights.__getitem__)
+    longest = max(range(len(names)), key=chain_lengths.__getitem__)
 
-    honest_fraction = 100 - args.attack_fraction
+    print(f"Heaviest chain is now: {names[heaviest]}")
+    print(f"Longest chain is now: {names[longest]}")
 
-    if args.start_difficulty:
-        if args.start_difficulty <= 0:
-            raise RuntimeError("Starting difficulty must be >0")
+def next_attack_power(strategy, mining_power, attack_share, name):
+    ''' Returns the mining power an attacker uses after one of its difficulty periods ended '''
+    if strategy == ALTERNATE:
+        if mining_power == attack_share:
+            log.info("%s halved its mining power", name)
+            return attack_share / 2
 
-        start_difficulty = args.start_difficulty
-    else:
-        print("No starting difficulty set. Will calculate")
-        start_difficulty = args.block_time * honest_fraction
+        log.info("%s restored its full mining power", name)
+        return attack_share
+
+    if strategy == STEP:
+        return min(attack_share, mining_power * 2)
+
+    return mining_power
+
+def simulate(strategy, start_difficulty, attack_fraction, period_length, block_time, num_blocks, num_attackers=1, early_exit=False):
+    '''
+    Runs a single simulation until the first chain reaches num_blocks.
+    The strategy is one of NORMAL, STEP, or ALTERNATE and applies to all attackers,
+    which each get an equal share of the attack fraction.
+    Returns the final chain weights and lengths, indexed by miner.
+
+    With early_exit, the simulation also stops once no chain can overtake the heaviest one,
+    even if it mined all its remaining blocks at its current difficulty.
+
+    Every block and difficulty change, and every time another chain becomes the heaviest,
+    is logged at INFO level. The overall state of the chains is only reported once by the caller,
+    after the simulation ends.
+    '''
 
-    difficulties = [start_difficulty, start_difficulty]
-    block_times = [[], []]
-    chain_weights = [0, 0]
-    chain_lengths = [0, 0]
-    mining_powers = [honest_fraction, args.attack_fraction]
+    # Checked once, so no messages are built when they would be discarded
+    verbose = log.isEnabledFor(logging.INFO)
 
-    if args.strategy in ["step"]:
-        mining_powers[ATTACKER] = args.attack_fraction * 0.1
+    names = miner_names(num_attackers)
+    num_miners = num_attackers + 1
 
-    next_block_times = [
-        calculate_block_interval(difficulties[HONEST], mining_powers[HONEST]),
-        calculate_block_interval(difficulties[ATTACKER], mining_powers[ATTACKER])
-    ]
+    honest_fraction = 100 - attack_fraction
+    attack_share = attack_fraction / num_attackers
+    # How long a difficulty period should take; this does not change during the simulation
+    expected = period_length * block_time
 
-    while chain_lengths[0] < args.num_blocks and chain_lengths[1] < args.num_blocks:
-        if next_block_times[0] <= next_block_times[1]:
-            idx = 0
-        else:
-            idx = 1
+    difficulties = [start_difficulty] * num_miners
+    # Time at which the current difficulty period started for each chain
+    period_starts = [0] * num_miners
+    chain_weights = [0] * num_miners
+    chain_lengths = [0] * num_miners
+    mining_powers = [honest_fraction] + [attack_share] * num_attackers
 
-        time = next_block_times[idx]
-        print(f"## {to_name(idx)} created new block at time {time} ##")
+    if strategy == STEP:
+        for idx in range(1, num_miners):
+            mining_powers[idx] = attack_share * 0.1
+
+    # Holds the time of the next block for every miner, so the earliest one can be picked in O(log n).
+    # Ties are broken by index, so the honest miner goes first
+    next_blocks = [(calculate_block_interval(difficulties[idx], mining_powers[idx]), idx) for idx in range(num_miners)]
+    heapq.heapify(next_blocks)
+
+    # All chains start out empty, and ties go to the lower index
+    heaviest = HONEST
+
+    # The weight each chain would reach if it mined all its remaining blocks at its current difficulty.
+    # Mining a block does not change this, only a difficulty change does
+    potential_weights = [start_difficulty * num_blocks] * num_miners
+    # The highest potential weight of any chain other than the heaviest one
+    catch_up = start_difficulty * num_blocks
+
+    while True:
+        # Only peek here; the entry is replaced with the miner's next block at the end of the iteration
+        time, idx = next_blocks[0]
 
-        block_times[idx].append(time)
         chain_weights[idx] += difficulties[idx]
         chain_lengths[idx] += 1
 
-        if chain_lengths[idx] % args.period_length == 0:
+        if verbose:
+            log.info("## %s created new block at time %s (length=%s, weight=%s) ##",
+                     names[idx], time, chain_lengths[idx], chain_weights[idx])
+
+        # Only this chain's weight changed, so it is the only one that can have taken the lead
+        lead_changed = idx != heaviest and (chain_weights[idx], -idx) > (chain_weights[heaviest], -heaviest)
+        if lead_changed:
+            heaviest = idx
+            if verbose:
+                log.info("%s is now the heaviest chain", names[heaviest])
+
+        retargeted = chain_lengths[idx] % period_length == 0
+        if retargeted:
             assert chain_lengths[idx] > 0
 
             # We always start measuring from the end of the previous period
-            # If there is none, pick 0
-            if chain_lengths[idx] == args.period_length:
-                start = 0
-            else:
-                start = block_times[idx][-(args.period_length+1)]
-
-            actual = block_times[idx][-1] - start
-            expected = args.period_length * args.block_time
+            # If there is none, this is 0
+            actual = time - period_starts[idx]
+            period_starts[idx] = time
             change = expected / actual
 
             old = difficulties[idx]
 
             if abs(change) > 0.0001:
-                print(f"Changing difficulty for {to_name(idx)} by {change}: {old} -> {difficulties[idx]}")
                 difficulties[idx] = old * change
-            else:
-                print(f"Difficulty for {to_name(idx)} stayed the same: {old}")
-
-            if idx == ATTACKER:
-                if args.strategy == "alternate":
-                    if mining_powers[ATTACKER] == args.attack_fraction:
-                        print("Attacker halved its mining power")
-                        mining_powers[ATTACKER] = args.attack_fraction / 2
-                    else:
-                        print("Attacker restored its full mining power")
-                        mining_powers[ATTACKER] = args.attack_fraction
-                elif args.strategy == "step":
-                    mining_powers[ATTACKER] = min(args.attack_fraction, mining_powers[ATTACKER] * 2)
-
-        print(f"Chain lengths are now {to_name(0)}={chain_lengths[0]} {to_name(1)}={chain_lengths[1]}")
-        print(f"Chain weights are now {to_name(0)}={chain_weights[0]} {to_name(1)}={chain_weights[1]}")
-
-        if chain_weights[0] >= chain_weights[1]:
-            print(f"Heaviest chain is now: {to_name(0)}")
-        else:
-            print(f"Heaviest chain is now: {to_name(1)}")
-
-        if chain_lengths[0] >= chain_lengths[1]:
-            print(f"Longest chain is now: {to_name(0)}")
-        else:
-            print(f"Longest chain is now: {to_name(1)}")
-
-
-        next_block_times[idx] = time + calculate_block_interval(difficulties[idx], mining_powers[idx])
+                if verbose:
+                    log.info("Changing difficulty for %s by %s: %s -> %s", names[idx], change, old, difficulties[idx])
+            elif verbose:
+                log.info("Difficulty for %s stayed the same: %s", names[idx], old)
+
+            if early_exit:
+                potential_weights[idx] = chain_weights[idx] + difficulties[idx] * (num_blocks - chain_lengths[idx])
+
+            if idx != HONEST:
+                mining_powers[idx] = next_attack_power(strategy, mining_powers[idx], attack_share, names[idx])
+
+        # Only this chain grew, so it is the only one that can have reached the end
+        if chain_lengths[idx] >= num_blocks:
+            break
+
+        if early_exit:
+            # Only scan all chains when the bound can actually have changed
+            if lead_changed or retargeted:
+                catch_up = max(weight for (other, weight) in enumerate(potential_weights) if other != heaviest)
+
+            if chain_weights[heaviest] > catch_up:
+                if verbose:
+                    log.info("No chain can overtake %s anymore", names[heaviest])
+                break
+
+        heapq.heapreplace(next_blocks, (time + calculate_block_interval(difficulties[idx], mining_powers[idx]), idx))
+
+    return chain_weights, chain_lengths
+
+def main():
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stdout, format="%(message)s", level=logging.INFO if args.verbose else logging.WARNING)
+
+    if args.attack_fraction >= 50:
+        raise RuntimeError("Attacker must have am minority of the mining power")
+    if args.attack_fraction <= 0:
+        raise RuntimeError("Attacker' must have a mining power >0")
+    if args.num_attackers <= 0:
+        raise RuntimeError("There must be at least one attacker")
+    if args.num_blocks <= 0:
+        raise RuntimeError("Number of blocks must be >0")
+
+    honest_fraction = 100 - args.attack_fraction
+
+    if args.start_difficulty:
+        if args.start_difficulty <= 0:
+            raise RuntimeError("Starting difficulty must be >0")
+
+        start_difficulty = args.start_difficulty
+    else:
+        print("No starting difficulty set. Will calculate")
+        start_difficulty = args.block_time * honest_fraction
+
+    chain_weights, chain_lengths = simulate(STRATEGIES.index(args.strategy), start_difficulty, args.attack_fraction,
+                                            args.period_length, args.block_time, args.num_blocks,
+                                            num_attackers=args.num_attackers, early_exit=args.early_exit)
+
+    if max(chain_lengths) < args.num_blocks:
+        print("## Simulation stopped early ##")
+    else:
+        print("## Simulation finished ##")
+    print_status(miner_names(args.num_attackers), chain_weights, chain_lengths)
 
 if __name__ == "__main__":
     main()
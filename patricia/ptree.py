@@ -7,125 +7,253 @@ Some simplifications:
     * On-disk format less space-efficient but easier to understand
 """
 
+from functools import lru_cache
 from hashlib import sha3_256
 
-import rlp
-
 BITS_PER_NIBBLE = 4
 BRANCHING_FACTOR = pow(2, BITS_PER_NIBBLE)
 
-def bytes_to_nibbles(key: bytes) -> [int]:
+# Node types, stored in the kind attribute of every node.
+# Comparing these is cheaper than calling isinstance on the hot paths.
+BRANCH = 0
+EXTENSION = 1
+LEAF = 2
+
+# RLP encoding of an empty string (and of the integer 0)
+_RLP_EMPTY = b"\x80"
+# RLP header of a 32-byte string, i.e., a node hash
+_RLP_HASH_HEADER = b"\xa0"
+
+# Lookup tables mapping a byte to its lower and upper nibble
+_LOW_NIBBLES = bytes(byte % BRANCHING_FACTOR for byte in range(256))
+_HIGH_NIBBLES = bytes(byte // BRANCHING_FACTOR for byte in range(256))
+
+@lru_cache(maxsize=65536)
+def bytes_to_nibbles(key: bytes) -> bytes:
+    """
+    Splits the key into nibbles (lower nibble first) without looping in Python.
+    The result holds one nibble per byte, in the same format as the paths stored in nodes.
+    """
     assert isinstance(key, bytes)
 
-    result = []
-    for byte in key:
-        result.append(byte % BRANCHING_FACTOR)
-        result.append(byte // BRANCHING_FACTOR)
+    result = bytearray(2 * len(key))
+    result[0::2] = key.translate(_LOW_NIBBLES)
+    result[1::2] = key.translate(_HIGH_NIBBLES)
+
+    return bytes(result)
+
+def _rlp_length(length: int, offset: int) -> bytes:
+    """
+    RLP header for a payload of the given length.
+    The offset is 0x80 for strings and 0xc0 for lists.
+    """
+    if length <= 55:
+        return bytes([offset + length])
+
+    encoded = length.to_bytes((length.bit_length() + 7) // 8, "big")
+    return bytes([offset + 55 + len(encoded)]) + encoded
+
+def _rlp_bytes(data: bytes) -> bytes:
+    if len(data) == 1 and data[0] < 0x80:
+        return data
 
-    return result
+    return _rlp_length(len(data), 0x80) + data
+
+def _rlp_nibbles(nibbles: bytes) -> bytes:
+    """
+    Encodes a path as a list of integers.
+    Nibbles 1-15 encode as themselves, but RLP encodes 0 as the empty string.
+    """
+    payload = nibbles.replace(b"\x00", _RLP_EMPTY)
+    return _rlp_length(len(payload), 0xc0) + payload
+
+def _rlp_list(payload: bytes) -> bytes:
+    return _rlp_length(len(payload), 0xc0) + payload
 
 class Branch:
+    __slots__ = ("bitmap", "children", "data", "hash")
+    kind = BRANCH
+
     def __init__(self):
-        """ A branch in the tree. Can have multiple children and also a leaf """
+        """
+        A branch in the tree. Can have multiple children and also a leaf.
+
+        Only children that exist are stored, ordered by their index.
+        Bit i of the bitmap is set if there is a child at index i.
+        """
 
-        self.children = [None for _ in range(BRANCHING_FACTOR)]
+        self.bitmap = 0
+        self.children = []
         self.data = None
         self.hash = None
 
-    def get(self, path: [int]):
-        if len(path) == 0:
-            return self.data
-
-        idx = path.pop(0)
-        if self.children[idx] is None:
+    def get_child(self, idx: int):
+        bit = 1 << idx
+        if not self.bitmap & bit:
             return None
 
-        return self.children[idx].get(path)
+        return self.children[(self.bitmap & (bit - 1)).bit_count()]
 
-    def set(self, path: [int], data: bytes):
-        """ Add a new child to this branch """
-        assert self.hash is None
+    def set_child(self, idx: int, child):
+        """ Add or replace the child at the specified index """
+        bit = 1 << idx
+        pos = (self.bitmap & (bit - 1)).bit_count()
 
-        if len(path) == 0:
-            self.data = data
-            return
+        if self.bitmap & bit:
+            self.children[pos] = child
+        else:
+            self.children.insert(pos, child)
+            self.bitmap |= bit
 
-        idx = path.pop(0)
-        child = self.children[idx]
+    def get(self, path: bytes, offset: int):
+        if offset == len(path):
+            return self.data
 
+        child = self.get_child(path[offset])
         if child is None:
-            self.children[idx] = Leaf(path, data)
-        elif isinstance(child, Branch):
-            child.set(path, data)
-        elif isinstance(child, Extension):
-            pos = 0
-            while len(child.path) > pos and len(path) > 0 and path[0] == child.path[pos]:
-                path.pop(0)
-                pos += 1
+            return None
 
-            if len(child.path) == pos:
-                child.child.set(path, data)
-            else:
-                branch = Branch()
-                branch.set(path, data)
-                branch.set(child.path[pos:], child.child)
+        return child.get(path, offset + 1)
 
-                if pos > 0:
-                    newext = child.path[:pos]
-                    self.children[idx] = Extension(newext, branch)
-                else:
-                    self.children[idx] = branch
+    def set(self, path: bytes, offset: int, data: bytes):
+        """
+        Add a new child below this branch. Only path[offset:] is relevant at this level.
+        Walks down the tree in a loop instead of recursing for every level.
+        """
+        node = self
 
-        elif isinstance(child, Leaf):
-            pos = 0
-            while len(child.suffix) > pos and len(path) > 0 and path[0] == child.suffix[pos]:
-                path.pop(0)
-                pos += 1
+        while True:
+            assert node.hash is None
+
+            if offset == len(path):
+                node.data = data
+                return
+
+            idx = path[offset]
+            offset += 1
+            child = node.get_child(idx)
+
+            if child is None:
+                node.set_child(idx, Leaf(path[offset:], data))
+                return
+
+            kind = child.kind
+
+            if kind == BRANCH:
+                if child.is_sealed():
+                    child = child.copy()
+                    node.set_child(idx, child)
+
+                node = child
+            elif kind == EXTENSION:
+                pos = 0
+                limit = min(len(child.path), len(path) - offset)
+                while pos < limit and path[offset + pos] == child.path[pos]:
+                    pos += 1
+
+                if len(child.path) == pos:
+                    if child.is_sealed():
+                        child = child.copy()
+                        node.set_child(idx, child)
+                    if child.child.is_sealed():
+                        child.child = child.child.copy()
+
+                    node = child.child
+                else:
+                    branch = Branch()
+
+                    # Hang the remainder of the extension below the new branch
+                    rest = child.path[pos:]
+                    if len(rest) == 1:
+                        branch.set_child(rest[0], child.child)
+                    else:
+                        branch.set_child(rest[0], Extension(rest[1:], child.child))
+
+                    if pos > 0:
+                        newext = child.path[:pos]
+                        node.set_child(idx, Extension(newext, branch))
+                    else:
+                        node.set_child(idx, branch)
+
+                    node = branch
+
+                offset += pos
+            elif kind == LEAF:
+                pos = 0
+                limit = min(len(child.suffix), len(path) - offset)
+                while pos < limit and path[offset + pos] == child.suffix[pos]:
+                    pos += 1
+
+                if len(child.suffix) == pos and len(path) == offset + pos:
+                    if child.is_sealed():
+                        child = child.copy()
+                        node.set_child(idx, child)
+
+                    child.data = data
+                    return
 
-            if len(child.suffix) == pos and len(path) == 0:
-                child.data = data
-            else:
                 branch = Branch()
-                branch.set(path, data)
-                branch.set(child.suffix[pos:], child.data)
+
+                # Move the remainder of the old leaf below the new branch
+                rest = child.suffix[pos:]
+                if len(rest) == 0:
+                    branch.data = child.data
+                else:
+                    branch.set_child(rest[0], Leaf(rest[1:], child.data))
 
                 if pos > 0:
                     newext = child.suffix[:pos]
-                    self.children[idx] = Extension(newext, branch)
+                    node.set_child(idx, Extension(newext, branch))
                 else:
-                    self.children[idx] = branch
-        else:
-            raise RuntimeError("Invalid state!")
+                    node.set_child(idx, branch)
+
+                node = branch
+                offset += pos
+            else:
+                raise RuntimeError("Invalid state!")
 
     def seal(self):
+        """ Hash this branch. All children must have been sealed already. """
         to_hash = []
+        pos = 0
 
-        for child in self.children:
-            if child is None:
-                to_hash.append(0)
+        for idx in range(BRANCHING_FACTOR):
+            if self.bitmap & (1 << idx):
+                child = self.children[pos]
+                pos += 1
+
+                assert child.is_sealed()
+                to_hash.append(_RLP_HASH_HEADER)
+                to_hash.append(child.hash)
             else:
-                to_hash.append(child.seal())
+                to_hash.append(_RLP_EMPTY)
 
         if self.data is None:
-            to_hash.append(0)
+            to_hash.append(_RLP_EMPTY)
         else:
-            to_hash.append(self.data)
-
-        encoded = rlp.encode(to_hash)
+            to_hash.append(_rlp_bytes(self.data))
 
-        hasher = sha3_256()
-        hasher.update(encoded)
+        encoded = _rlp_list(b"".join(to_hash))
 
-        self.hash = hasher.digest()
+        self.hash = sha3_256(encoded).digest()
         return self.hash
 
+    def copy(self):
+        """ Create an unsealed copy of this branch that shares all children """
+
+        newbranch = Branch()
+        newbranch.bitmap = self.bitmap
+        newbranch.children = list(self.children)
+        newbranch.data = self.data
+        return newbranch
+
     def clone(self):
-        """ Create a unsealed copy of this branch """
+        """ Create a unsealed copy of this branch. Sealed subtrees are shared. """
 
         newbranch = Branch()
-        for (idx, child) in enumerate(self.children):
-            if child is not None:
-                newbranch.children[idx] = child.clone()
+        newbranch.bitmap = self.bitmap
+        newbranch.children = [child if child.is_sealed() else child.clone()
+                              for child in self.children]
         newbranch.data = self.data
         return newbranch
 
@@ -133,98 +261,115 @@ class Branch:
         return self.hash is not None
 
     def print(self):
-        child_idx = []
-        for (idx, child) in enumerate(self.children):
-            if child is not None:
-                child_idx.append(hex(idx))
+        child_idx = [hex(idx) for idx in range(BRANCHING_FACTOR) if self.bitmap & (1 << idx)]
         print(f"Branch with children at {child_idx} and data={self.data}")
         for child in self.children:
-            if child is not None:
-                child.print()
+            child.print()
 
 class Extension:
-    """ An extension node that compacts a part of the tree without branching """
+    """
+    An extension node that compacts a part of the tree without branching.
+    The path is stored as bytes holding one nibble each.
+    """
+
+    __slots__ = ("path", "child", "hash")
+    kind = EXTENSION
 
-    def __init__(self, path: [int], child):
+    def __init__(self, path: bytes, child):
         self.path = path
         self.child = child
         self.hash = None
 
     def seal(self):
-        child_hash = self.child.seal()
-        to_hash = [self.path, child_hash]
-
-        encoded = rlp.encode(to_hash)
-
-        hasher = sha3_256()
-        hasher.update(encoded)
+        """ Hash this extension. The child must have been sealed already. """
+        assert self.child.is_sealed()
+        encoded = _rlp_list(_rlp_nibbles(self.path) + _RLP_HASH_HEADER + self.child.hash)
 
-        self.hash = hasher.digest()
+        self.hash = sha3_256(encoded).digest()
         return self.hash
 
+    def is_sealed(self) -> bool:
+        return self.hash is not None
+
     def print(self):
         print(f"Extension with path={[hex(p) for p in self.path]}")
         self.child.print()
 
-    def get(self, path: [int]):
-        if len(path) < len(self.path):
+    def get(self, path: bytes, offset: int):
+        end = offset + len(self.path)
+        if path[offset:end] != self.path:
             return None
 
-        prefix = path[:len(self.path)]
-        if prefix != self.path:
-            return None
+        return self.child.get(path, end)
 
-        return self.child.get(path[len(self.path):])
+    def copy(self):
+        """ Create an unsealed copy of this extension that shares its child """
+        return Extension(self.path, self.child)
 
     def clone(self):
-        """ Create a unsealed copy of this extension """
+        """ Create a unsealed copy of this extension. A sealed child is shared. """
+
+        if self.child.is_sealed():
+            return self.copy()
 
         newchild = self.child.clone()
         return Extension(self.path, newchild)
 
 class Leaf:
-    """ A leaf node with an (optional) suffix. Directly holds data. """
+    """
+    A leaf node with an (optional) suffix. Directly holds data.
+    The suffix is stored as bytes holding one nibble each.
+    """
 
-    def __init__(self, suffix: [int], data: bytes):
+    __slots__ = ("suffix", "data", "hash")
+    kind = LEAF
+
+    def __init__(self, suffix: bytes, data: bytes):
         self.suffix = suffix
         self.data = data
         self.hash = None
 
     def seal(self):
-        to_hash = [self.suffix, self.data]
-
-        encoded = rlp.encode(to_hash)
-
-        hasher = sha3_256()
-        hasher.update(encoded)
+        encoded = _rlp_list(_rlp_nibbles(self.suffix) + _rlp_bytes(self.data))
 
-        self.hash = hasher.digest()
+        self.hash = sha3_256(encoded).digest()
         return self.hash
 
+    def is_sealed(self) -> bool:
+        return self.hash is not None
+
     def print(self):
         print(f"Leaf with suffix={[hex(s) for s in self.suffix]} and data={self.data}")
 
-    def set(self, path: [int], data: bytes):
+    def set(self, path: bytes, offset: int, data: bytes):
         assert self.hash is None
-        assert path == self.suffix
+        assert path[offset:] == self.suffix
         self.data = data
 
-    def get(self, path: [int]):
-        if path != self.suffix:
+    def get(self, path: bytes, offset: int):
+        if path[offset:] != self.suffix:
             return None
 
         return self.data
 
-    def clone(self):
-        """ Create a unsealed copy of this leaf """
+    def copy(self):
+        """ Create an unsealed copy of this leaf """
         return Leaf(self.suffix, self.data)
 
+    def clone(self):
+        """ Create a unsealed copy of this leaf. Same as copy(), as leaves have no children """
+        return self.copy()
+
 class PatriciaTree:
     def __init__(self, prev=None):
-        if prev:
-            self.root = prev.root.clone()
-        else:
+        if prev is None:
             self.root = Branch()
+        elif prev.is_sealed():
+            # Sealed nodes are never modified, so they can be shared with prev
+            # and are only copied once a change touches them
+            self.root = prev.root.copy()
+        else:
+            self.root = prev.root.clone()
 
     def is_sealed(self) -> bool:
         return self.root.is_sealed()
@@ -234,21 +379,54 @@ class PatriciaTree:
             raise RuntimeError("Already sealed!")
 
         nkey = bytes_to_nibbles(key)
-        self.root.set(nkey, data)
+        self.root.set(nkey, 0, data)
 
     def clone(self): # -> PatriciaTree:
         """
-        Start building a new block from the sealed a
-        Will perform copy on write for all changes done
+        Start building a new block from this one.
+        If this tree is sealed, this takes constant time and will
+        perform copy on write for all changes done.
         """
         return PatriciaTree(prev=self)
 
     def get(self, key: bytes):
         nkey = bytes_to_nibbles(key)
-        return self.root.get(nkey)
+        return self.root.get(nkey, 0)
 
     def print(self):
         self.root.print()
 
     def seal(self):
-        return self.root.seal()
+        """
+        Hash all nodes bottom-up and return the root hash.
+        Uses an explicit stack so that sealing does not recurse per node.
+
+        Subtrees that are already sealed, e.g., those shared with the tree this one
+        was cloned from, keep their hash and are not visited again.
+        """
+        stack = [(self.root, False)]
+
+        while stack:
+            node, children_sealed = stack.pop()
+
+            if children_sealed:
+                node.seal()
+                continue
+
+            if node.is_sealed():
+                # Sealed nodes are never modified, so the hash is still valid
+                continue
+
+            if node.kind == LEAF:
+                node.seal()
+                continue
+
+            # Revisit the node once everything below it is sealed
+            stack.append((node, True))
+
+            if node.kind == BRANCH:
+                stack.extend((child, False) for child in node.children)
+            else:
+                stack.append((node.child, False))
+
+        return self.root.hash
@@ -30,3 +30,49 @@ def test_clone():
     p.set(b"foo", b"bar")
     p2 = p.clone()
     assert p2.get(b"foo") == b"bar"
+
+
+def test_split_extension():
+    p = PatriciaTree()
+    p.set(b"\x00", b"a")
+    p.set(b"\x00\x00", b"b")
+    p.set(b"\x10", b"c")
+
+    assert p.get(b"\x00") == b"a"
+    assert p.get(b"\x00\x00") == b"b"
+    assert p.get(b"\x10") == b"c"
+    p.seal()
+
+
+def test_clone_sealed():
+    p = PatriciaTree()
+    p.set(b"foo", b"bar")
+    p.set(b"fab", b"hi")
+    root = p.seal()
+
+    p2 = p.clone()
+    p2.set(b"foo", b"baz")
+    p2.set(b"faz", b"hello")
+
+    assert p.get(b"foo") == b"bar"
+    assert p.get(b"faz") is None
+    assert p2.get(b"foo") == b"baz"
+    assert p2.get(b"fab") == b"hi"
+    assert p2.get(b"faz") == b"hello"
+
+    p3 = PatriciaTree()
+    p3.set(b"foo", b"baz")
+    p3.set(b"fab", b"hi")
+    p3.set(b"faz", b"hello")
+
+    assert p2.seal() == p3.seal()
+    assert p.seal() == root
+
+
+def test_seal_hash():
+    p = PatriciaTree()
+    p.set(b"foo", b"bar")
+    p.set(b"fab", b"hi")
+    p.set(b"faz", b"x" * 100)
+
+    assert p.seal().hex() == "19a7f0af1978e873c9c0fe376f00a912a76d0af1ebdb86c7a858a553b01ebae1"